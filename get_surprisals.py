@@ -4,7 +4,9 @@
 #  PYTHONPATH=src ./train --dataset <file|directory|glob>
 
 import argparse
+import itertools
 import json
+import multiprocessing
 import os
 import numpy as np
 import tensorflow as tf
@@ -14,11 +16,13 @@ from tensorflow.core.protobuf import rewriter_config_pb2
 
 import model, sample, encoder
 from load_dataset import load_dataset, Sampler
-from accumulate import AccumulatingOptimizer
-import memory_saving_gradients
 
 CHECKPOINT_DIR = 'checkpoint'
 SAMPLE_DIR = 'samples'
+# Converts natural-log losses (nats) into bits.
+INV_LN2 = np.float32(1.0 / np.log(2.0))
+# Below this many sentences a process pool costs more than it saves.
+PARALLEL_MIN_SENTS = 5000
 
 
 parser = argparse.ArgumentParser(
@@ -55,7 +59,7 @@ parser.add_argument('--sample_num', metavar='N', type=int, default=1, help='Gene
 parser.add_argument('--save_every', metavar='N', type=int, default=1000, help='Write a checkpoint every N steps')
 
 parser.add_argument('--val_dataset', metavar='PATH', type=str, default=None, help='Dataset for validation loss, defaults to --dataset.')
-parser.add_argument('--val_batch_size', metavar='SIZE', type=int, default=2, help='Batch size for validation.')
+parser.add_argument('--val_batch_size', metavar='SIZE', type=int, default=2, help='Batch size for validation and evaluation.')
 parser.add_argument('--val_batch_count', metavar='N', type=int, default=40, help='Number of batches for validation.')
 parser.add_argument('--val_every', metavar='STEPS', type=int, default=0, help='Calculate validation loss every STEPS steps.')
 parser.add_argument('--eval_dataset', metavar='PATH', type=str, default=None, help='Dataset for evaluation.')
@@ -64,6 +68,9 @@ parser.add_argument('--fpath', type=str, default=None, help='Path to write surpr
 
 parser.add_argument("--just_ppl", default=False, action="store_true")
 
+parser.add_argument('--mixed_precision', default=False, action='store_true', help='Let Grappler run the eval forward pass in float16 on GPU (TF 1.14+). Approximates surprisals.')
+parser.add_argument('--xla', default=False, action='store_true', help='JIT-compile the graph with XLA. Each new batch shape triggers a compile.')
+
 
 def maketree(path):
     try:
@@ -81,10 +88,98 @@ def randomize(context, hparams, p):
         return context
 
 
+def label_logprobs(h, wte, labels, n_chunks=8):
+    """Log-probability of each label from final hidden states h and tied embeddings wte.
+
+    The logits are computed in n_chunks slices of the vocabulary, run one after
+    another, so the [batch, sequence, n_vocab] tensor is never held at once.
+    Each slice contributes a partial logsumexp and, for labels that fall in it,
+    the label logit, so both come from the same (possibly float16) logits.
+    """
+    batch, sequence, n_embd = model.shape_list(h)
+    h_flat = tf.reshape(h, [batch*sequence, n_embd])
+    labels_flat = tf.reshape(labels, [-1])
+    rows = tf.range(batch*sequence)
+    n_vocab = wte.shape[0].value
+    chunk = -(-n_vocab // n_chunks)
+    partial_lse = []
+    label_logits = tf.zeros([batch*sequence], dtype=tf.float32)
+    for start in range(0, n_vocab, chunk):
+        size = min(chunk, n_vocab - start)
+        with tf.control_dependencies(partial_lse[-1:]):
+            # float32 even when the matmuls run in float16.
+            logits = tf.cast(tf.matmul(h_flat, wte[start:start+size], transpose_b=True), tf.float32)
+            partial_lse.append(tf.reduce_logsumexp(logits, axis=-1))
+            in_chunk = tf.logical_and(labels_flat >= start, labels_flat < start + size)
+            cols = tf.clip_by_value(labels_flat - start, 0, size - 1)
+            picked = tf.gather_nd(logits, tf.stack([rows, cols], axis=-1))
+            label_logits += tf.where(in_chunk, picked, tf.zeros_like(picked))
+    normalizer = tf.reduce_logsumexp(tf.stack(partial_lse, axis=-1), axis=-1)
+    return tf.reshape(label_logits - normalizer, [batch, sequence])
+
+
+def word_starts(token_strs, sent, words):
+    """Index of the first BPE token of each whitespace-separated word in sent.
+
+    token_strs maps each token id to its stripped decoded string.
+    """
+    starts = [0]
+    token_concat = ''
+    for token_index, token in enumerate(sent):
+        token_concat += token_strs[token]
+        if token_concat == words[len(starts) - 1]:
+            token_concat = ''
+            starts.append(token_index + 1)
+    assert len(starts) - 1 == len(words)
+    return starts[:-1]
+
+
+# Per-process state for the multiprocessing.Pool workers, set by init_worker().
+_worker_enc = None
+_worker_token_strs = None
+
+
+def init_worker(enc, token_strs=None):
+    global _worker_enc, _worker_token_strs
+    _worker_enc = enc
+    _worker_token_strs = token_strs
+
+
+def aggregate_sentence(sent_index, sent, surps):
+    """TSV rows, one newline-terminated line per word, for a single sentence."""
+    words = _worker_enc.decode(sent).split()
+    if not words:
+        return ''
+    # Token 0 has no prediction and counts as zero surprisal.
+    token_surps = np.concatenate([np.zeros(1, dtype=surps.dtype), surps])
+    starts = word_starts(_worker_token_strs, sent, words)
+    # str() keeps the float32 repr; formatting via float would widen it.
+    values = [str(surprisal) for surprisal in np.add.reduceat(token_surps, starts)]
+    if (starts[1] if len(starts) > 1 else len(sent)) == 1:
+        # A first word made of token 0 alone was never summed, so it prints as 0.
+        values[0] = '0'
+    return ''.join('\t'.join((str(sent_index+1), str(word_index+1), word, values[word_index])) + '\n'
+                   for word_index, word in enumerate(words))
+
+
+def encode_line(line):
+    return _worker_enc.encode(line.strip())
+
+
 def load_eval_dataset(enc, path, encoding=None):
     with open(path, 'r', encoding=encoding) as f:
-        lines = f.readlines()
-    enc_lines = [enc.encode(line.strip()) for line in lines]
+        text = f.read()
+    lines = text.split('\n')
+    if lines[-1] == '':
+        # Same lines as readlines(): no extra entry after a final newline.
+        lines.pop()
+    # Lines encode independently; blank lines are kept so sentence ids still
+    # match line numbers. Must run before any tf.Session exists, since the
+    # pool forks.
+    if len(lines) < PARALLEL_MIN_SENTS:
+        return [enc.encode(line.strip()) for line in lines]
+    with multiprocessing.Pool(initializer=init_worker, initargs=(enc,)) as pool:
+        enc_lines = pool.map(encode_line, lines, chunksize=256)
     return enc_lines
 
 
@@ -113,21 +208,57 @@ def main():
         raise ValueError(
             "Can't get samples longer than window size: %s" % hparams.n_ctx)
 
-    if args.model_name == '345M':
+    # Loaded before the session: the encoder pool must not fork a live TF runtime.
+    if args.eval_dataset:
+        print(args.eval_dataset)
+        eval_sents = load_eval_dataset(enc, args.eval_dataset, encoding=args.encoding)
+
+    training = not (args.eval or args.just_ppl)
+
+    if training and args.model_name == '345M':
         args.memory_saving_gradients = True
         if args.optimizer == 'adam':
             args.only_train_transformer_layers = True
 
     config = tf.ConfigProto()
     config.gpu_options.allow_growth = True
-    config.graph_options.rewrite_options.layout_optimizer = rewriter_config_pb2.RewriterConfig.OFF
+    # Eval issues many small session runs, so favour the Grappler passes that
+    # shrink the graph and skip the ones that only add per-run overhead.
+    rc = config.graph_options.rewrite_options
+    rc.constant_folding = rewriter_config_pb2.RewriterConfig.ON
+    rc.arithmetic_optimization = rewriter_config_pb2.RewriterConfig.ON
+    rc.remapping = rewriter_config_pb2.RewriterConfig.ON
+    rc.dependency_optimization = rewriter_config_pb2.RewriterConfig.ON
+    rc.memory_optimization = rewriter_config_pb2.RewriterConfig.NO_MEM_OPT
+    rc.auto_parallel.enable = False
+    # Negative means never skip Grappler; 0 would keep the small-graph cutoff.
+    rc.min_graph_nodes = -1
+    if not tf.test.is_built_with_cuda():
+        # NCHW layout rewrites only pay off on GPU.
+        rc.layout_optimizer = rewriter_config_pb2.RewriterConfig.OFF
+    if args.mixed_precision:
+        # Only available from TF 1.14; GPU-only, so a no-op on CPU.
+        if 'auto_mixed_precision' in rc.DESCRIPTOR.fields_by_name:
+            rc.auto_mixed_precision = rewriter_config_pb2.RewriterConfig.ON
+        else:
+            print('auto_mixed_precision not supported by this TensorFlow, using float32.')
+    # Keep small host-side ops off the GPU so they don't split the eval
+    # subgraph across devices. Added after TF 1.12.
+    if 'pin_to_host_optimization' in rc.DESCRIPTOR.fields_by_name:
+        rc.pin_to_host_optimization = rewriter_config_pb2.RewriterConfig.ON
+    # The eval forward is pinned to /gpu:0 below; fall back if there is none.
+    config.allow_soft_placement = True
+    if args.xla:
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
     with tf.Session(config=config) as sess:
-        context = tf.placeholder(tf.int32, [args.batch_size, None])
-        context_in = randomize(context, hparams, args.noise)
-        output = model.model(hparams=hparams, X=context_in)
-        loss = tf.reduce_mean(
-            tf.nn.sparse_softmax_cross_entropy_with_logits(
-                labels=context[:, 1:], logits=output['logits'][:, :-1]))
+        # The training graph only adds nodes for Grappler to walk in eval runs.
+        if training:
+            context = tf.placeholder(tf.int32, [args.batch_size, None])
+            context_in = randomize(context, hparams, args.noise)
+            output = model.model(hparams=hparams, X=context_in)
+            loss = tf.reduce_mean(
+                tf.nn.sparse_softmax_cross_entropy_with_logits(
+                    labels=context[:, 1:], logits=output['logits'][:, :-1]))
 
         if args.val_every > 0:
             val_context = tf.placeholder(tf.int32, [args.val_batch_size, None])
@@ -137,14 +268,36 @@ def main():
                     labels=val_context[:, 1:], logits=val_output['logits'][:, :-1]))
             val_loss_summary = tf.summary.scalar('val_loss', val_loss)
 
-        if args.eval:
-            # val_context = tf.placeholder(tf.int32, [args.val_batch_size, None])
-            # val_output = model.model(hparams=hparams, X=val_context)
-            val_logprobs = tf.nn.sparse_softmax_cross_entropy_with_logits(
-                    labels=val_context[:, 1:], logits=val_output['logits'][:, :-1])
+        if not training:
+            # Separate from the validation graph so --eval works without
+            # --val_every. get_logprobs() initializes the iterator with every
+            # sentence packed into one int32 array plus [start, end) bounds;
+            # slicing, padding and prefetching then happen inside tf.data, so
+            # the next batch is staged while the current one runs.
+            eval_tokens = tf.placeholder(tf.int32, [None])
+            eval_bounds = tf.placeholder(tf.int32, [None, 2])
+            eval_dataset = tf.data.Dataset.from_tensor_slices(eval_bounds).map(
+                lambda bounds: eval_tokens[bounds[0]:bounds[1]])
+            eval_dataset = eval_dataset.padded_batch(
+                args.val_batch_size, padded_shapes=[None]).prefetch(4)
+            eval_iterator = eval_dataset.make_initializable_iterator()
+            eval_init = eval_iterator.initializer
+            eval_context = eval_iterator.get_next()
+            # The input pipeline stays on the host; everything from the
+            # forward pass to the label gather and bits conversion runs on
+            # the GPU, so only the [batch, sequence-1] result is copied back.
+            with tf.device('/gpu:0' if tf.test.is_built_with_cuda() else '/cpu:0'):
+                eval_output = model.model(hparams=hparams, X=eval_context)
+                with tf.variable_scope('model', reuse=True):
+                    wte = tf.get_variable('wte')
+                # Built from the hidden states; eval_output['logits'] is never run.
+                eval_logprobs = -label_logprobs(eval_output['h'][:, :-1], wte, eval_context[:, 1:])
+                # Surprisal in bits, computed on device.
+                eval_surprisals = eval_logprobs * INV_LN2
 
         all_vars = [v for v in tf.trainable_variables() if 'model' in v.name]
-        train_vars = [v for v in all_vars if '/h' in v.name] if args.only_train_transformer_layers else all_vars
+        if training:
+            train_vars = [v for v in all_vars if '/h' in v.name] if args.only_train_transformer_layers else all_vars
 
         saver = tf.train.Saver(
             var_list=all_vars,
@@ -167,6 +320,29 @@ def main():
         print('Loading checkpoint', ckpt)
         saver.restore(sess, ckpt)
 
+        eval_sess = sess
+        if not training:
+            # Weights are fixed from here on, so fold them into constants and
+            # run eval from a frozen copy of the graph. GraphDefs cannot exceed
+            # 2GB, which rules this out for the larger models.
+            var_bytes = sum(v.shape.num_elements() * v.dtype.base_dtype.size for v in all_vars)
+            if var_bytes < 2**31 - 2**26:
+                frozen = tf.graph_util.convert_variables_to_constants(
+                    sess, sess.graph.as_graph_def(), [eval_surprisals.op.name, eval_init.name])
+                eval_graph = tf.Graph()
+                with eval_graph.as_default():
+                    eval_surprisals, eval_init, eval_tokens, eval_bounds = tf.import_graph_def(
+                        frozen, return_elements=[eval_surprisals.name, eval_init.name,
+                                                 eval_tokens.name, eval_bounds.name], name='')
+                # The GraphDef holds its own copy of the weights; the imported
+                # graph has what it needs, so don't keep it alive for the run.
+                del frozen
+                # Closing the variable session releases its weight buffers.
+                eval_sess = tf.Session(graph=eval_graph, config=config)
+                sess.close()
+            else:
+                print('Model too large to freeze, evaluating from variables.')
+
         print('batch size:', args.batch_size)
 
         print('Loading dataset...')
@@ -181,10 +357,6 @@ def main():
         #         val_chunks = chunks
         # print('dataset has', data_sampler.total_size, 'tokens')
 
-        if args.eval_dataset:
-            print(args.eval_dataset)
-            eval_sents = load_eval_dataset(enc, args.eval_dataset, encoding=args.encoding)
-
         counter = 1
         counter_path = os.path.join(args.checkpoint_dir, args.run_name, 'counter')
         if os.path.exists(counter_path):
@@ -193,62 +365,83 @@ def main():
             with open(counter_path, 'r') as fp:
                 counter = int(fp.read()) + 1
 
+        def get_logprobs():
+            # Returns per-token surprisals in bits, one array per sentence.
+            # Repeated sentences are only run once.
+            unique_index = {}
+            unique_sents = []
+            for sent in eval_sents:
+                key = tuple(sent)
+                if key not in unique_index:
+                    unique_index[key] = len(unique_sents)
+                    unique_sents.append(key)
+            # Run in length order so each batch pads to a similar length, then
+            # scatter the results back through the permutation.
+            order = np.argsort([len(sent) for sent in unique_sents], kind='mergesort')
+            sorted_sents = [unique_sents[i] for i in order]
+            # Sentences under two tokens have nothing to predict; being the
+            # shortest they all sit at the front.
+            n_short = sum(1 for sent in sorted_sents if len(sent) < 2)
+            results = [np.zeros(0, dtype=np.float32)] * n_short
+            # One packed copy of the tokens is handed to the graph up front,
+            # instead of a py_func converting each sentence as it is pulled.
+            runnable = sorted_sents[n_short:]
+            lengths = np.array([len(sent) for sent in runnable], dtype=np.int32)
+            ends = np.cumsum(lengths, dtype=np.int32)
+            bounds = np.stack([ends - lengths, ends], axis=-1)
+            tokens = np.fromiter(itertools.chain.from_iterable(runnable), dtype=np.int32)
+            eval_sess.run(eval_init, feed_dict={eval_tokens: tokens, eval_bounds: bounds})
+            with tqdm.tqdm(total=len(sorted_sents)) as pbar:
+                pbar.update(n_short)
+                while True:
+                    try:
+                        batch_logprobs = eval_sess.run(eval_surprisals)
+                    except tf.errors.OutOfRangeError:
+                        break
+                    # Padding sits after each sentence, so causal attention
+                    # leaves the real positions untouched; just drop the
+                    # padded tail.
+                    for row in batch_logprobs:
+                        results.append(row[:len(sorted_sents[len(results)]) - 1])
+                    pbar.update(len(batch_logprobs))
+            unique_logprobs = [None] * len(unique_sents)
+            for k, unique_id in enumerate(order):
+                unique_logprobs[unique_id] = results[k]
+            return [unique_logprobs[unique_index[tuple(sent)]] for sent in eval_sents]
+
         def get_surprisals():
             print('Get surprisals...')
-            logprobs_list = []
-            for sent in tqdm.tqdm(eval_sents):
-                logprobs_list.append(sess.run(val_logprobs, feed_dict={val_context: args.val_batch_size * [sent]})[0])
+            logprobs_list = get_logprobs()
+
+            # Decode each distinct token once rather than once per occurrence.
+            token_strs = {token: enc.decode([token]).strip()
+                          for token in set(itertools.chain.from_iterable(eval_sents))}
+            # Sentences are independent, so large sets are aligned and
+            # formatted across worker processes; starmap() keeps input order.
+            # Closing the session stops its tf.data threads, but the forked
+            # workers still inherit the loaded TF runtime (CUDA context,
+            # process-wide thread pools). They only run NumPy and the
+            # encoder and never call into TF, which is all that is relied on.
+            eval_sess.close()
+            work = zip(range(len(eval_sents)), eval_sents, logprobs_list)
+            if len(eval_sents) < PARALLEL_MIN_SENTS:
+                init_worker(enc, token_strs)
+                rows = list(itertools.starmap(aggregate_sentence, work))
+            else:
+                with multiprocessing.Pool(initializer=init_worker, initargs=(enc, token_strs)) as pool:
+                    rows = pool.starmap(aggregate_sentence, work, chunksize=64)
 
-            with open(args.fpath, 'w', encoding="utf-8") as f:
-                # Write header.
+            with open(args.fpath, 'w', buffering=1 << 20, encoding="utf-8") as f:
                 f.write("sentence_id\ttoken_id\ttoken\tsurprisal\n")
-
-                for sent_index, sent in enumerate(eval_sents):
-                    words = enc.decode(sent).split()
-
-                    # for token_index, token in enumerate(sent):
-                    #     if token_index == 0:
-                    #         f.write(str(sent_index+1)+'\t'+str(token_index+1)+'\t'+enc.decode([token])+'\t0.0\n')
-                    #     else:
-                    #         f.write(str(sent_index+1)+'\t'+str(token_index+1)+'\t'+enc.decode([token])+'\t'+str(-np.log2(np.exp(-logprobs_list[sent_index][token_index-1])))+'\n')
-
-                    surprisals = []
-                    token_concat = ''
-                    surprisal_sum = 0
-                    word_index = 0
-                    for token_index, token in enumerate(sent):
-                        # print(token_concat)
-                        token_concat += enc.decode([token]).strip()
-
-                        if token_index > 0:
-                            surprisal_sum += -np.log2(np.exp(-logprobs_list[sent_index][token_index-1]))
-                        if token_concat == words[word_index]:
-                            f.write(str(sent_index+1)+'\t'+str(word_index+1)+'\t'+words[word_index]+'\t'+str(surprisal_sum)+'\n')
-                            token_concat = ''
-                            surprisal_sum = 0
-                            word_index += 1
-                    # print(word_index, len(words))
-                    assert word_index == len(words)
+                f.write("".join(rows))
 
         def get_ppl():
             print('Get perplexity...')
-            logprobs_list = []
-            for sent in tqdm.tqdm(eval_sents):
-                logprobs_list.append(sess.run(val_logprobs, feed_dict={val_context: args.val_batch_size * [sent]})[0])
-            total_surprisal = 0
-            total_wcount = 0
-            for sent_index, sent in enumerate(eval_sents):
-                words = enc.decode(sent).split()
-                total_wcount += len(words)
-                for token_index, token in enumerate(sent):
-                    if token_index == 0:
-                        continue
-
-                    try:
-                        total_surprisal += -np.log2(np.exp(-logprobs_list[sent_index][token_index-1]))
-                    except:
-                        import pdb; pdb.set_trace()
-            ppl = np.exp(total_surprisal/total_wcount)
+            logprobs_list = get_logprobs()
+            # One flat float64 sum over every token's surprisal (already in bits).
+            total_surprisal = np.concatenate(logprobs_list).sum(dtype=np.float64)
+            total_wcount = sum([len(enc.decode(sent).split()) for sent in eval_sents])
+            ppl = 2 ** (total_surprisal / total_wcount)
             print('Perplexity:', ppl)
 
 
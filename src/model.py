@@ -204,6 +204,7 @@ def model(hparams, X, past=None, scope='model', reuse=tf.AUTO_REUSE):
 
         # Final layer normalization.
         h = norm(h, 'ln_f')
+        results['h'] = h
 
         # Language model loss.  Do tokens <n predict token n?
         h_flat = tf.reshape(h, [batch*sequence, hparams.n_embd])